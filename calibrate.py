@@ -0,0 +1,238 @@
+"""
+Track calibration tool for the F1 race simulator.
+Reads real lap time CSV files in chunks and fits the TRACKS parameters (base lap times, abrasion, track variation)
+and the compound wear rates against the same Tyre model the simulator uses, then writes a track profile that
+trackspec.py loads on start-up.
+
+The CSV files need a header with at least these columns (any extra columns are ignored):
+    track, compound, lap_time, tyre_age
+where tyre_age is the number of laps the tyre has done including this one (1 = first lap on new tyres).
+In/out laps and safety car laps should be removed beforehand as they are not tyre limited.
+
+Usage:
+    python calibrate.py season_2024.csv more_laps.csv -o track_profile.json
+"""
+
+import argparse
+import csv
+import json
+import sys
+from itertools import islice
+
+import numpy as np
+
+from trackspec import COMPOUNDS, TRACKS, TRACK_PROFILE, Tyre
+
+COMPOUND_NAMES = list(COMPOUNDS)
+REQUIRED_COLUMNS = ('track', 'compound', 'lap_time', 'tyre_age')
+
+# Candidate per-lap wear rates (compound wear rate x track abrasion) tried for every track and compound at once
+WEAR_GRID = np.geomspace(0.001, 0.1, 400)
+
+def to_float(values):
+    # Converts a column of text cells to floats, anything that isn't a number ('', 'DNF', ...) becomes NaN
+    try:
+        return np.asarray(values, dtype=float)
+    except ValueError:
+        # Only chunks with bad cells get here, and each distinct cell is converted once
+        unique, inverse = np.unique(values, return_inverse=True)
+        converted = np.empty(len(unique))
+        for i, cell in enumerate(unique):
+            try:
+                converted[i] = float(cell)
+            except ValueError:
+                converted[i] = np.nan
+        return converted[inverse]
+
+class LapStats:
+    # Running totals per track, compound and tyre age. This is everything the least squares fit needs,
+    # so the raw laps never have to be kept in memory.
+    def __init__(self, max_age=80):
+        self.max_age = max_age
+        self.tracks = []
+        self.track_index = {}
+        self.count = np.zeros((0, len(COMPOUND_NAMES), max_age))
+        self.sum_time = np.zeros((0, len(COMPOUND_NAMES), max_age))
+        self.sum_time_sq = np.zeros((0, len(COMPOUND_NAMES)))
+        self.skipped = 0
+
+    def _track_ids(self, names):
+        # Only the unique track names in a chunk go through Python, the rows are mapped with numpy
+        unique, inverse = np.unique(names, return_inverse=True)
+        for name in unique:
+            if name not in self.track_index:
+                self.track_index[name] = len(self.tracks)
+                self.tracks.append(name)
+        new = len(self.tracks) - self.count.shape[0]
+        if new:
+            self.count = np.pad(self.count, ((0, new), (0, 0), (0, 0)))
+            self.sum_time = np.pad(self.sum_time, ((0, new), (0, 0), (0, 0)))
+            self.sum_time_sq = np.pad(self.sum_time_sq, ((0, new), (0, 0)))
+        return np.array([self.track_index[name] for name in unique], dtype=np.intp)[inverse]
+
+    def add_chunk(self, tracks, compounds, lap_times, tyre_ages):
+        unique, inverse = np.unique(np.char.lower(np.char.strip(compounds)), return_inverse=True)
+        compound_ids = np.array([COMPOUND_NAMES.index(c) if c in COMPOUNDS else -1 for c in unique])[inverse]
+        lap_times = to_float(lap_times)
+        ages = to_float(tyre_ages)
+        valid = (compound_ids >= 0) & np.isfinite(lap_times) & (ages >= 1) & (ages <= self.max_age)
+        self.skipped += int(np.count_nonzero(~valid))
+        if not valid.any():
+            return
+
+        track_ids = self._track_ids(np.char.strip(tracks[valid]))
+        compound_ids = compound_ids[valid]
+        lap_times = lap_times[valid]
+        ages = ages[valid].astype(np.intp) - 1
+
+        n_compounds = len(COMPOUND_NAMES)
+        cells = (track_ids * n_compounds + compound_ids) * self.max_age + ages
+        size = self.count.size
+        self.count += np.bincount(cells, minlength=size).reshape(self.count.shape)
+        self.sum_time += np.bincount(cells, weights=lap_times, minlength=size).reshape(self.count.shape)
+        groups = track_ids * n_compounds + compound_ids
+        self.sum_time_sq += np.bincount(groups, weights=lap_times ** 2,
+                                        minlength=self.sum_time_sq.size).reshape(self.sum_time_sq.shape)
+
+def read_laps(paths, stats, chunk_size=200000):
+    for path in paths:
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            header = [h.strip().lower() for h in next(reader, [])]
+            missing = [c for c in REQUIRED_COLUMNS if c not in header]
+            if missing:
+                raise ValueError(f"{path} is missing column(s): {', '.join(missing)}")
+            columns = [header.index(c) for c in REQUIRED_COLUMNS]
+            while True:
+                rows = list(islice(reader, chunk_size))
+                if not rows:
+                    break
+                table = np.array([[row[i] if i < len(row) else '' for i in columns] for row in rows])
+                # Cells that aren't numbers become NaN and are counted as skipped by add_chunk
+                stats.add_chunk(table[:, 0], table[:, 1], np.char.strip(table[:, 2]), np.char.strip(table[:, 3]))
+    return stats
+
+def lap_time_factors(max_age, wear_grid=WEAR_GRID):
+    # Runs the simulator's own Tyre model (aggression 1.0) for each compound and candidate wear rate and
+    # returns the lap time multiplier base_time is scaled by in Driver.simulate_lap, shape (compound, wear, age)
+    factors = np.empty((len(COMPOUND_NAMES), len(wear_grid), max_age))
+    for c, compound in enumerate(COMPOUND_NAMES):
+        for w, wear_rate in enumerate(wear_grid):
+            tyre = Tyre(compound=compound)
+            tyre.wear_rate = wear_rate
+            for age in range(max_age):
+                grip = tyre.update()['grip']
+                factors[c, w, age] = 1.0 + (1.0 - grip) * 3.0
+    return factors
+
+def fit_profile(stats, min_laps=20):
+    """Fits every track and compound in one go and returns a profile dict in the TRACKS layout."""
+    factors = lap_time_factors(stats.max_age)
+    n = stats.count.sum(axis=2)
+
+    # For each candidate wear rate the best base time has a closed form (least squares through the origin),
+    # so the error for every track, compound and candidate comes out of two matrix products
+    cross = np.einsum('tca,cwa->tcw', stats.sum_time, factors)
+    norm = np.einsum('tca,cwa->tcw', stats.count, factors ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sse = stats.sum_time_sq[:, :, None] - cross ** 2 / norm
+        best = np.nanargmin(np.where(norm > 0, sse, np.inf), axis=2)
+        t_idx, c_idx = np.indices(best.shape)
+        base_time = cross[t_idx, c_idx, best] / norm[t_idx, c_idx, best]
+        rms = np.sqrt(np.maximum(sse[t_idx, c_idx, best], 0) / n)
+    per_lap_wear = WEAR_GRID[best]
+    fitted = n >= min_laps
+
+    # A best fit on either end of WEAR_GRID is the grid's limit rather than a real optimum, so it isn't used
+    at_edge = fitted & ((best == 0) | (best == len(WEAR_GRID) - 1))
+    for t, c in zip(*np.nonzero(at_edge)):
+        print(f"Skipping {stats.tracks[t]} {COMPOUND_NAMES[c]}: per-lap wear is outside the "
+              f"{WEAR_GRID[0]:g}-{WEAR_GRID[-1]:g} search range", file=sys.stderr)
+    fitted &= ~at_edge
+
+    # Only tracks the profile can fully describe (every compound fitted or already in TRACKS) are kept,
+    # so the shared compound wear rates and the abrasion scale come from the saved tracks alone
+    tracks = []
+    for t in np.flatnonzero(fitted.any(axis=1)):
+        name = stats.tracks[t]
+        missing = [compound for c, compound in enumerate(COMPOUND_NAMES)
+                   if not fitted[t, c] and compound not in TRACKS.get(name, {})]
+        if missing:
+            print(f"Skipping {name}: not enough laps on {', '.join(missing)} tyres", file=sys.stderr)
+        else:
+            tracks.append(t)
+    if not tracks:
+        raise ValueError(f"No track has at least {min_laps} usable laps on every compound it needs")
+    fitted = fitted & np.isin(np.arange(len(fitted)), tracks)[:, None]
+    compounds = np.flatnonzero(fitted.any(axis=0))
+
+    # Split the per-lap wear into a compound wear rate and a track abrasion (log wear = log rate + log abrasion),
+    # weighted by lap count. Rates and abrasions can be traded against each other by any common factor, so the
+    # scale is pinned: if some TRACKS aren't being calibrated their hand-entered abrasions were set against the
+    # current compound rates, so those rates keep their average. Otherwise abrasion averages 1.0.
+    saved = {stats.tracks[t] for t in tracks}
+    uncalibrated = [name for name in TRACKS if name not in saved]
+    rows, targets, weights = [], [], []
+    for ti, t in enumerate(tracks):
+        for ci, c in enumerate(compounds):
+            if fitted[t, c]:
+                row = np.zeros(len(compounds) + len(tracks))
+                row[ci] = 1.0
+                row[len(compounds) + ti] = 1.0
+                rows.append(row)
+                targets.append(np.log(per_lap_wear[t, c]))
+                weights.append(np.sqrt(n[t, c]))
+    anchor = np.zeros(len(compounds) + len(tracks))
+    if uncalibrated:
+        anchor[:len(compounds)] = 1.0
+        targets.append(sum(np.log(COMPOUNDS[COMPOUND_NAMES[c]]['wear_rate']) for c in compounds))
+    else:
+        anchor[len(compounds):] = 1.0
+        targets.append(0.0)
+    rows.append(anchor)
+    weights.append(np.sqrt(n[fitted].sum()))
+    weights = np.array(weights)
+    solution = np.linalg.lstsq(np.array(rows) * weights[:, None], np.array(targets) * weights, rcond=None)[0]
+    wear_rates = dict(zip((COMPOUND_NAMES[c] for c in compounds), np.exp(solution[:len(compounds)])))
+    abrasion = np.exp(solution[len(compounds):])
+    for compound, rate in wear_rates.items():
+        change = rate / COMPOUNDS[compound]['wear_rate'] - 1
+        if uncalibrated and abs(change) >= 0.01:
+            print(f"Warning: {compound} wear rate changes by {change:+.0%}, which also applies to tracks "
+                  f"not in the data: {', '.join(uncalibrated)}", file=sys.stderr)
+
+    profile = {"tracks": {}, "compounds": {c: {"wear_rate": round(float(r), 4)} for c, r in wear_rates.items()}}
+    for ti, t in enumerate(tracks):
+        name = stats.tracks[t]
+        track = {}
+        for c, compound in enumerate(COMPOUND_NAMES):
+            if fitted[t, c]:
+                track[compound] = {"base_time": round(float(base_time[t, c]), 3),
+                                   "wear_rate": round(float(wear_rates[compound]), 4)}
+        # Track variation is the lap-to-lap scatter (s) left over once tyre wear is accounted for
+        track["track_variation"] = round(float(np.sqrt((rms[t] ** 2 * n[t])[fitted[t]].sum() / n[t][fitted[t]].sum())), 3)
+        track["abrasion"] = round(float(abrasion[ti]), 3)
+        profile["tracks"][name] = track
+    return profile
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit track and tyre parameters from real lap time CSV files.")
+    parser.add_argument('csv_files', nargs='+', help="lap time CSV files (track, compound, lap_time, tyre_age)")
+    parser.add_argument('-o', '--output', default=TRACK_PROFILE, help="where to write the track profile JSON")
+    parser.add_argument('--chunk-size', type=int, default=200000, help="rows read per chunk")
+    parser.add_argument('--max-age', type=int, default=80, help="ignore laps on tyres older than this")
+    parser.add_argument('--min-laps', type=int, default=20, help="laps needed to fit a track/compound")
+    args = parser.parse_args(argv)
+
+    try:
+        stats = read_laps(args.csv_files, LapStats(max_age=args.max_age), chunk_size=args.chunk_size)
+        profile = fit_profile(stats, min_laps=args.min_laps)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    with open(args.output, 'w') as f:
+        json.dump(profile, f, indent=4)
+    print(f"Calibrated {len(profile['tracks'])} track(s) from {int(stats.count.sum())} laps "
+          f"({stats.skipped} skipped), profile saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
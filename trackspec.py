@@ -12,6 +12,7 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import random
 import csv
+import json
 import os
 from datetime import datetime
 
@@ -41,6 +42,93 @@ TRACKS = {
     }
 }
 
+# COMPOUND DEFINITIONS
+# Base wear rate, temperature sensitivity and grip for each tyre compound, used by the Tyre class.
+COMPOUNDS = {
+    "soft":   {"wear_rate": 0.025, "temp_sensitivity": 1.2, "base_grip": 1.1},
+    "medium": {"wear_rate": 0.018, "temp_sensitivity": 1.0, "base_grip": 1.0},
+    "hard":   {"wear_rate": 0.012, "temp_sensitivity": 0.8, "base_grip": 0.9}
+}
+
+# Track profile written by calibrate.py, loaded on start-up if it sits next to this file
+TRACK_PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "track_profile.json")
+
+def load_track_profile(path=TRACK_PROFILE):
+    # Merges a calibrated profile into TRACKS and COMPOUNDS, values missing from the profile keep their defaults
+    with open(path) as f:
+        profile = json.load(f)
+    for name, track in profile.get("tracks", {}).items():
+        current = TRACKS.setdefault(name, {})
+        for key, value in track.items():
+            if isinstance(value, dict):
+                current.setdefault(key, {}).update(value)
+            else:
+                current[key] = value
+    for compound, params in profile.get("compounds", {}).items():
+        COMPOUNDS.setdefault(compound, {}).update(params)
+    return profile
+
+# RACE EVENTS
+# Compact event records published by the simulator. The message text is only built when something asks for it (str()),
+# so a race with no listeners never formats a string.
+PIT_STOP = 'pit_stop'
+PUNCTURE = 'puncture'
+WEAR_CRITICAL = 'wear_critical'
+LAP_COMPLETE = 'lap_complete'
+POSITION_CHANGE = 'position_change'
+
+CRITICAL_WEAR = 80  # Wear % that triggers a critical wear event, below the 85% puncture point (AI pits here too)
+
+EVENT_MESSAGES = {
+    PIT_STOP:        lambda e: f"{e.driver} pitted for {e.value.upper()} tires on Lap {e.lap}",
+    PUNCTURE:        lambda e: "TIRE PUNCTURE! Lap time severely affected. Pit stop recommended." if e.driver == "You"
+                               else f"{e.driver} suffered a tire puncture on Lap {e.lap}",
+    WEAR_CRITICAL:   lambda e: "Critical tire wear! Consider making a pit stop soon." if e.driver == "You"
+                               else f"{e.driver} has critical tire wear ({e.value:.1f}%) on Lap {e.lap}",
+    LAP_COMPLETE:    lambda e: f"{e.driver} completed Lap {e.lap} in {e.value:.3f}s",
+    POSITION_CHANGE: lambda e: f"{e.driver} moved from P{e.value[0]} to P{e.value[1]} on Lap {e.lap}",
+}
+
+class RaceEvent:
+    __slots__ = ('kind', 'lap', 'driver', 'value')
+
+    def __init__(self, kind, lap, driver, value=None):
+        self.kind = kind
+        self.lap = lap
+        self.driver = driver
+        self.value = value  # compound for pit stops, wear % for wear, lap time for laps, (old, new) for positions
+
+    def __str__(self):
+        return EVENT_MESSAGES[self.kind](self)
+
+    def __repr__(self):
+        return f"RaceEvent({self.kind!r}, {self.lap}, {self.driver!r}, {self.value!r})"
+
+class EventBus:
+    def __init__(self):
+        self.subscribers = {}
+
+    def subscribe(self, kind, callback):
+        self.subscribers.setdefault(kind, []).append(callback)
+
+    def unsubscribe(self, kind, callback):
+        callbacks = self.subscribers.get(kind, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    def wants(self, kind):
+        return bool(self.subscribers.get(kind))
+
+    def publish(self, kind, lap, driver, value=None):
+        # Nothing is allocated when no one is listening for this kind of event
+        callbacks = self.subscribers.get(kind)
+        if not callbacks:
+            return None
+        event = RaceEvent(kind, lap, driver, value)
+        for callback in list(callbacks):
+            callback(event)
+        return event
+
 # Tyre class with physics from the first sim
 class Tyre:
     def __init__(self, compound='soft', initial_temp=90, initial_pressure=2.2):
@@ -50,19 +138,11 @@ class Tyre:
         self.puncture_threshold = 0.85 # Puncture threshold (wear > 85%)
         self.punctured = False
         
-        # Compound-specific parameters
-        if self.compound == 'soft':
-            self.wear_rate = 0.025
-            self.temp_sensitivity = 1.2
-            self.base_grip = 1.1
-        elif self.compound == 'medium':
-            self.wear_rate = 0.018
-            self.temp_sensitivity = 1.0
-            self.base_grip = 1.0
-        else:
-            self.wear_rate = 0.012
-            self.temp_sensitivity = 0.8
-            self.base_grip = 0.9
+        # Compound-specific parameters (anything unknown behaves like a hard)
+        params = COMPOUNDS.get(self.compound, COMPOUNDS['hard'])
+        self.wear_rate = params['wear_rate']
+        self.temp_sensitivity = params['temp_sensitivity']
+        self.base_grip = params['base_grip']
         
         self.temperature = initial_temp
         self.pressure = initial_pressure
@@ -144,6 +224,7 @@ class Driver:
         self.current_lap = 0
         self.tyre = Tyre(compound=initial_tire)
         self.pit_stop_count = 0 
+        self.pitted = False  # set when the car pits before its next lap
     
     def simulate_lap(self, sim, aggression=1.0):
         tyre = self.tyre
@@ -175,13 +256,14 @@ class Driver:
         
         self.total_time += lap_time
         self.current_lap += 1
+        pitted, self.pitted = self.pitted, False
         
         self.lap_data.append(LapData(
             self.current_lap,
             lap_time,
             tyre_status['wear'],
             compound,
-            False,  # pit stop is handled separately
+            pitted,
             tyre_status['punctured'],
             tyre_status['temperature'],
             tyre_status['pressure']
@@ -196,7 +278,7 @@ class F1Simulator:
         self.pit_stop_scheduled = False
         self.next_pit_compound = None
         self.drivers = []
-        self.pit_events = [] 
+        self.events = EventBus()
         self.user_aggression = 1.0   
     
     @property
@@ -211,51 +293,78 @@ class F1Simulator:
     def get_track_abrasion(self):
         return TRACKS[self.track_name].get('abrasion', 1.0)
     
+    def standings(self):
+        return sorted(self.drivers, key=lambda d: (-d.current_lap, d.total_time))
+
+    def _run_driver_lap(self, driver, lap, **kwargs):
+        # Simulates one lap and publishes what changed for this driver
+        was_punctured = driver.tyre.punctured
+        was_critical = driver.tyre.wear * 100 > CRITICAL_WEAR
+        driver.simulate_lap(self, **kwargs)
+        events = self.events
+        if events.wants(LAP_COMPLETE):
+            events.publish(LAP_COMPLETE, lap, driver.name, driver.lap_data[-1].lap_time)
+        if driver.tyre.punctured and not was_punctured:
+            events.publish(PUNCTURE, lap, driver.name)
+        if not was_critical and driver.tyre.wear * 100 > CRITICAL_WEAR:
+            events.publish(WEAR_CRITICAL, lap, driver.name, driver.tyre.wear * 100)
+
+    def _pit(self, driver, compound, lap):
+        driver.tyre = Tyre(compound=compound)
+        driver.pit_stop_count += 1
+        driver.pitted = True
+        return self.events.publish(PIT_STOP, lap, driver.name, compound)
+
     def simulate_next_lap(self):
+        """Runs one lap for every driver. Returns (still_running, warning) where warning is a RaceEvent for
+        the user's car (puncture, critical wear or pit stop) or None, and always None once the race is over.
+        Everything else goes out on self.events."""
         if self.current_lap >= self.total_laps:
-            return False, "Race completed!"
-        warning_msg = ""
-        pit_msg = ""
+            return False, None
+        lap = self.current_lap + 1
+        pitted = None
+        track_positions = self.events.wants(POSITION_CHANGE)
+        if track_positions:
+            old_positions = {d.name: pos for pos, d in enumerate(self.standings(), 1)}
 
         # Perform pit stop if scheduled for user
+        user_driver = next(d for d in self.drivers if d.name == "You")
         if self.pit_stop_scheduled:
-            user_driver = next(d for d in self.drivers if d.name == "You")
             new_compound = self.next_pit_compound if self.next_pit_compound else random.choice(['soft', 'medium', 'hard'])
-            user_driver.tyre = Tyre(compound=new_compound)
-            user_driver.pit_stop_count += 1
+            self._pit(user_driver, new_compound, lap)
+            pitted = new_compound
             self.pit_stop_scheduled = False
             self.next_pit_compound = None
-            pit_msg = f"You pitted for {new_compound.upper()} tires on Lap {self.current_lap + 1}"
-            self.pit_events.append(pit_msg)
 
         # Simulate user lap with aggression slider value
-        user_driver = next(d for d in self.drivers if d.name == "You")
-        user_driver.simulate_lap(self, aggression=self.user_aggression)
+        self._run_driver_lap(user_driver, lap, aggression=self.user_aggression)
 
         # Simulate AI laps with random aggression
         for driver in self.drivers:
             if driver.name != "You" and driver.current_lap < self.total_laps:
                 # AI simple pit logic
-                if driver.tyre.wear > 0.80 or driver.tyre.punctured:
-                    new_compound = random.choice(['soft', 'medium', 'hard'])
-                    driver.tyre = Tyre(compound=new_compound)
-                    driver.pit_stop_count += 1
-                    self.pit_events.append(f"{driver.name} pitted for {new_compound.upper()} tires on Lap {self.current_lap + 1}")
-                driver.simulate_lap(self)
+                if driver.tyre.wear * 100 > CRITICAL_WEAR or driver.tyre.punctured:
+                    self._pit(driver, random.choice(['soft', 'medium', 'hard']), lap)
+                self._run_driver_lap(driver, lap)
         
         # Update race state
         self.current_lap += 1
         self.race_time = max(driver.total_time for driver in self.drivers)
+
+        if track_positions:
+            for pos, driver in enumerate(self.standings(), 1):
+                if old_positions[driver.name] != pos:
+                    self.events.publish(POSITION_CHANGE, lap, driver.name, (old_positions[driver.name], pos))
         
         # Check user tyre warnings
-        tyre_status = user_driver.tyre.get_status()
-        if tyre_status['punctured']:
-            warning_msg = "TIRE PUNCTURE! Lap time severely affected. Pit stop recommended."
-        elif tyre_status['wear'] > 90:
-            warning_msg = "Critical tire wear! Consider making a pit stop soon."
-        elif pit_msg:
-            warning_msg = pit_msg
-        return True, warning_msg
+        tyre = user_driver.tyre
+        if tyre.punctured:
+            return True, RaceEvent(PUNCTURE, lap, user_driver.name)
+        if tyre.wear * 100 > CRITICAL_WEAR:
+            return True, RaceEvent(WEAR_CRITICAL, lap, user_driver.name, tyre.wear * 100)
+        if pitted:
+            return True, RaceEvent(PIT_STOP, lap, user_driver.name, pitted)
+        return True, None
     
     def manual_pit_stop(self, compound):
         if self.current_lap == 0:
@@ -458,7 +567,7 @@ class F1SimulatorApp:
         self.pitstop_btn.state(['!disabled'])
         self.export_btn.state(['disabled'])
         self.status_var.set("Race started! Click 'Next Lap' to progress")
-        self.sim.pit_events.clear()
+        self.subscribe_events()
         self.pit_text.config(state='normal')
         self.pit_text.delete("1.0", tk.END)
         self.pit_text.config(state='disabled')
@@ -480,7 +589,7 @@ class F1SimulatorApp:
         self.pitstop_btn.state(['disabled'])
         self.export_btn.state(['disabled'])
         self.status_var.set("Race reset")
-        self.sim.pit_events.clear()
+        self.subscribe_events()
         self.pit_text.config(state='normal')
         self.pit_text.delete("1.0", tk.END)
         self.pit_text.config(state='disabled')
@@ -492,8 +601,8 @@ class F1SimulatorApp:
         self.sim.user_aggression = self.aggression_var.get()  
         laps_to_run = self.laps_to_progress_var.get()
         for _ in range(laps_to_run):
-            cont, status = self.sim.simulate_next_lap()
-            self.status_var.set(status)
+            cont, warning = self.sim.simulate_next_lap()
+            self.status_var.set(str(warning) if warning is not None else "")
             if not cont:
                 self.next_btn.state(['disabled'])
                 self.pitstop_btn.state(['disabled'])
@@ -503,7 +612,7 @@ class F1SimulatorApp:
         self.update_ui()
         self.update_charts()
         self.update_leaderboard()
-        self.update_pit_log()
+        self.pit_text.see(tk.END)
     
     def manual_pit_stop(self):
         compound = self.manual_pit_stop_dialog()
@@ -668,14 +777,14 @@ class F1SimulatorApp:
             )
         self.leaderboard.tag_configure("you", background="#ffff88")
     
-    def update_pit_log(self):
-        if self.sim.pit_events:
-            self.pit_text.config(state='normal')
-            for event in self.sim.pit_events:
-                self.pit_text.insert(tk.END, event + "\n")
-            self.sim.pit_events.clear()
-            self.pit_text.see(tk.END)
-            self.pit_text.config(state='disabled')
+    def subscribe_events(self):
+        # Pit stops are pushed straight into the log as they happen
+        self.sim.events.subscribe(PIT_STOP, self.on_pit_stop)
+    
+    def on_pit_stop(self, event):
+        self.pit_text.config(state='normal')
+        self.pit_text.insert(tk.END, f"{event}\n")
+        self.pit_text.config(state='disabled')
     
     def format_time(self, seconds):
         mins = int(seconds // 60)
@@ -683,6 +792,8 @@ class F1SimulatorApp:
         return f"{mins}:{secs:06.3f}"
 
 if __name__ == "__main__":
+    if os.path.exists(TRACK_PROFILE):
+        load_track_profile()
     root = tk.Tk()
     root.state('zoomed')
     app = F1SimulatorApp(root)